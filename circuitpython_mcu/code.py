@@ -1,4 +1,3 @@
-import binascii
 import time
 
 import board
@@ -8,6 +7,12 @@ from digitalio import DigitalInOut, Direction, Pull
 import supervisor
 
 VERSION = "0.0.1"
+# Report DIO_READ of an output pin from the last value written, rather than reading the pin
+CACHE_OUTPUT_READS = False
+# Interval between LED updates, independent of command handling
+LED_TICK = 0.1
+# Longest wait for serial input while idle
+SERIAL_POLL = 0.005
 if board.board_id == 'raspberry_pi_pico':
     ALIVE_LED = board.LED
     DIO_PINS = [board.GP0, board.GP1, board.GP2, board.GP3, board.GP20, board.GP21, board.GP22, board.GP23]
@@ -26,11 +31,17 @@ else:
     SPI_IRQ = board.A0
     SPI_RST = board.D5
 
+# Arguments to DIO_DIRECTION that select an output, in the usual spellings
+OUT_TOKENS = frozenset(("1", "OUT", "OUTPUT", "out", "output"))
+
+# Nibble value of each ASCII hex digit, 0xFF for anything else
+HEX_LUT = bytes(int(chr(i), 16) if chr(i) in "0123456789abcdefABCDEF" else 0xFF for i in range(256))
+
 
 def bytes_to_hex(data):
     if isinstance(data, int):
         data = bytes([data])
-    return "".join([chr(b) for b in binascii.hexlify(data, " ")])
+    return data.hex(" ")
     
 
 def hexstr_to_bytes(hex_str):
@@ -41,22 +52,36 @@ def hexstr_to_bytes(hex_str):
     Insert leading 0 if single digit value
     """
     if isinstance(hex_str, str):
-        if " " in hex_str:
-            hex_str = hex_str.replace(" ", ":")
+        # Single split pass in the usual space separated case
         if ":" in hex_str:
-            hex_values = hex_str.split(":")
-        else:
-            hex_values = [hex_str]
+            hex_str = hex_str.replace(":", " ")
+        hex_values = hex_str.split()
     else:
-        hex_values = hex_str
-    clean_hex_values = []
+        # Iterated more than once below
+        hex_values = list(hex_str)
+    # Whole byte values need no padding, so can be decoded in one builtin call
     for hex_value in hex_values:
         if len(hex_value) % 2:
-            clean_hex_values.append("0" + hex_value)
-        else:
-            clean_hex_values.append(hex_value)
-    clean_hex_str = "".join(clean_hex_values)
-    return binascii.unhexlify(clean_hex_str)
+            break
+    else:
+        return bytes.fromhex("".join(hex_values))
+    data = bytearray(sum((len(hex_value) + 1) // 2 for hex_value in hex_values))
+    index = 0
+    for hex_value in hex_values:
+        # An odd length value starts with an implied leading 0 nibble
+        high_nibble = not len(hex_value) % 2
+        byte = 0
+        for char in hex_value.encode():
+            nibble = HEX_LUT[char]
+            if nibble == 0xFF:
+                raise ValueError("Invalid hex value: " + hex_value)
+            if high_nibble:
+                byte = nibble << 4
+            else:
+                data[index] = byte | nibble
+                index += 1
+            high_nibble = not high_nibble
+    return bytes(data)
 
 
 def code_version():
@@ -69,42 +94,54 @@ class DigitalIo:
     
     These are mapped to the physical IO pins that are available.
     """
-    def __init__(self):
-        self._logical_pins = []
-        for pin in DIO_PINS:
-            new_pin = DigitalInOut(pin)
-            new_pin.direction = Direction.INPUT
-            new_pin.pull = Pull.DOWN
-            self._logical_pins.append(new_pin)
+    def __init__(self, cache_output_reads=False):
+        # Parallel arrays of pin state, indexed by logical pin number
+        self._pins = tuple(DigitalInOut(pin) for pin in DIO_PINS)
+        self._board_pins = tuple(DIO_PINS)
+        self._n = len(self._pins)
+        self._directions = [Direction.INPUT] * self._n
+        self._last_write = [False] * self._n
+        self._cache_output_reads = cache_output_reads
+        for pin in self._pins:
+            pin.direction = Direction.INPUT
+            pin.pull = Pull.DOWN
 
     def direction(self, pin_num, output):
-        if pin_num < len(self._logical_pins):
-            if output.upper() in ("1", "OUT", "OUTPUT"):
-                self._logical_pins[pin_num].direction = Direction.OUTPUT
+        if 0 <= pin_num < self._n:
+            pin = self._pins[pin_num]
+            if output in OUT_TOKENS or output.upper() in OUT_TOKENS:
+                pin.direction = Direction.OUTPUT
+                self._directions[pin_num] = Direction.OUTPUT
+                # Outputs start low
+                self._last_write[pin_num] = False
             else:
-                self._logical_pins[pin_num].direction = Direction.INPUT
-                self._logical_pins[pin_num].pull = Pull.DOWN
-            return str(pin_num) + " " + str(self._logical_pins[pin_num].direction)
+                pin.direction = Direction.INPUT
+                pin.pull = Pull.DOWN
+                self._directions[pin_num] = Direction.INPUT
+            return str(pin_num) + " " + str(self._directions[pin_num])
         else:
             return "ERROR: Unknown Pin: " + str(pin_num)
 
     def list_pins(self):
-        output_str = [""]
-        for pin_num, pin in enumerate(self._logical_pins):
-            output_str.append("    " + str(pin_num) + " " + str(DIO_PINS[pin_num]) + " " + str(pin.direction) + " " + str(pin.value))
+        # Leading empty line puts the listing below the command echo
+        output_str = [""] * (self._n + 1)
+        board_pins = self._board_pins
+        for pin_num, pin in enumerate(self._pins):
+            output_str[pin_num + 1] = f"    {pin_num} {board_pins[pin_num]} {pin.direction} {pin.value}"
         return "\n".join(output_str)
 
     def set_or_clear(self, pin_num, set_value):
-        pin_num = int(pin_num)
-        if pin_num < len(self._logical_pins) and self._logical_pins[pin_num].direction == Direction.OUTPUT:
-            self._logical_pins[pin_num].value = set_value
+        if 0 <= pin_num < self._n and self._directions[pin_num] == Direction.OUTPUT:
+            self._pins[pin_num].value = set_value
+            self._last_write[pin_num] = set_value
             return str(pin_num) + " " + str(set_value)
         return "ERROR: Cannot set pin: " + str(pin_num)
 
     def read(self, pin_num):
-        pin_num = int(pin_num)
-        if pin_num < len(self._logical_pins):
-            return str(pin_num) + " " + str(self._logical_pins[pin_num].value)
+        if 0 <= pin_num < self._n:
+            if self._cache_output_reads and self._directions[pin_num] == Direction.OUTPUT:
+                return str(pin_num) + " " + str(self._last_write[pin_num])
+            return str(pin_num) + " " + str(self._pins[pin_num].value)
         return "ERROR: Cannot read pin: " + str(pin_num)
 
 
@@ -129,22 +166,21 @@ class Relay:
             dio_relay = DigitalInOut(relay_pin)
             dio_relay.direction = Direction.OUTPUT
             self.dio_relays.append(dio_relay)
+        self._n = len(self.dio_relays)
 
     def list_pins(self):
-        output_str = [""]
+        output_str = [""] * (self._n + 1)
         for pin_num, pin in enumerate(self.dio_relays):
-            output_str.append("    " + str(pin_num) + " " + str(RELAY_PINS[pin_num]) + " " + str(pin.value))
+            output_str[pin_num + 1] = f"    {pin_num} {RELAY_PINS[pin_num]} {pin.value}"
         return "\n".join(output_str)
 
     def read(self, pin_num):
-        pin_num = int(pin_num)
-        if pin_num < len(self.dio_relays):
+        if 0 <= pin_num < self._n:
             return str(pin_num) + " " + str(self.dio_relays[pin_num].value)
         return "ERROR: Cannot read relay pin: " + str(pin_num)
 
     def set_or_clear(self, pin_num, set_value):
-        pin_num = int(pin_num)
-        if pin_num < len(self.dio_relays):
+        if 0 <= pin_num < self._n:
             self.dio_relays[pin_num].value = set_value
             return str(pin_num) + " " + str(set_value)
         return "ERROR: Cannot set relay pin: " + str(pin_num)
@@ -181,8 +217,7 @@ class SpiInterface:
             device.readinto(rx_buffer)
         return "Received: " + bytes_to_hex(rx_buffer)
 
-def help():
-    help_text = """
+HELP_TEXT = """
     Commands:
       HELP
       DIO_DIRECTION <pin number> <[OUT,IN]>
@@ -199,38 +234,38 @@ def help():
       VERSION
     """
 
-    return help_text
+# Command handlers, each taking the split command line
+ACTIONS = {
+    "HELP": lambda cmd_parts: HELP_TEXT,
+    "SPI_SEND": lambda cmd_parts: spi_interface.send(hexstr_to_bytes(cmd_parts[1:])),
+    "SPI_RECEIVE": lambda cmd_parts: spi_interface.receive(int(cmd_parts[1], 16)),
+    "DIO_DIRECTION": lambda cmd_parts: digital_io.direction(int(cmd_parts[1]), cmd_parts[2]),
+    "DIO_LIST": lambda cmd_parts: digital_io.list_pins(),
+    "DIO_CLEAR": lambda cmd_parts: digital_io.set_or_clear(int(cmd_parts[1]), False),
+    "DIO_SET": lambda cmd_parts: digital_io.set_or_clear(int(cmd_parts[1]), True),
+    "DIO_READ": lambda cmd_parts: digital_io.read(int(cmd_parts[1])),
+    "RELAY_LIST": lambda cmd_parts: relay.list_pins(),
+    "RELAY_CLEAR": lambda cmd_parts: relay.set_or_clear(int(cmd_parts[1]), False),
+    "RELAY_SET": lambda cmd_parts: relay.set_or_clear(int(cmd_parts[1]), True),
+    "RELAY_READ": lambda cmd_parts: relay.read(int(cmd_parts[1])),
+    "VERSION": lambda cmd_parts: code_version()
+}
 
 def handle_cmd(cmd):
     cmd_parts = cmd.split()
-    actions = {
-        "HELP": help,
-        "SPI_SEND": lambda: spi_interface.send(hexstr_to_bytes(cmd_parts[1:])),
-        "SPI_RECEIVE": lambda: spi_interface.receive(hexstr_to_bytes(cmd_parts[1])[0]),
-        "DIO_DIRECTION": lambda: digital_io.direction(int(cmd_parts[1]), cmd_parts[2]),
-        "DIO_LIST": lambda: digital_io.list_pins(),
-        "DIO_CLEAR": lambda: digital_io.set_or_clear(int(cmd_parts[1]), False),
-        "DIO_SET": lambda: digital_io.set_or_clear(int(cmd_parts[1]), True),
-        "DIO_READ": lambda: digital_io.read(int(cmd_parts[1])),
-        "RELAY_LIST": lambda: relay.list_pins(),
-        "RELAY_CLEAR": lambda: relay.set_or_clear(int(cmd_parts[1]), False),
-        "RELAY_SET": lambda: relay.set_or_clear(int(cmd_parts[1]), True),
-        "RELAY_READ": lambda: relay.read(int(cmd_parts[1])),
-        "VERSION": lambda: code_version()
-    }
     if cmd_parts:
         command = cmd_parts[0].upper()
-        action = actions.get(command, None)
+        action = ACTIONS.get(command, None)
         if action:
             try:
-                reply = action()
+                reply = action(cmd_parts)
             except Exception as exc:
                 print("EXCEPTION: Could not run: {} {} because {}".format(command, str(action), str(exc)))
             else:
                 print("{} {}".format(command, reply))
         else:
             print("{} not understood".format(command))
-            print(help())
+            print(HELP_TEXT)
 
 # Init
 spi_bus = busio.SPI(SPI_SCK, MOSI=SPI_MOSI, MISO=SPI_MISO)
@@ -244,16 +279,22 @@ rst = DigitalInOut(SPI_RST)
 
 spi_interface = SpiInterface(spi_device, irq, rst)
 led_handler = LedHandler(ALIVE_LED)
-digital_io = DigitalIo()
+digital_io = DigitalIo(cache_output_reads=CACHE_OUTPUT_READS)
 relay = Relay()
 supervisor.disable_autoreload() 
 
 # Main
 
+next_led_tick = time.monotonic() + LED_TICK
 while True:
     if supervisor.runtime.serial_bytes_available:
         cmd = input()
         handle_cmd(cmd)
-    time.sleep(0.1)
-    led_handler.update()
+    else:
+        time.sleep(max(0, min(SERIAL_POLL, next_led_tick - time.monotonic())))
+    now = time.monotonic()
+    if now >= next_led_tick:
+        led_handler.update()
+        # Don't try to catch up on ticks missed during a slow command
+        next_led_tick = max(next_led_tick + LED_TICK, now + LED_TICK)
 
@@ -1,18 +1,17 @@
 from functools import wraps
 import logging
 
+_log = logging.getLogger()
+
 def logged_call(func):
     """Decorator to add logging of function call entry and exit."""
     @wraps(func)
     def log_call(*args, **kwargs):
-        arg_values = []
-        for arg in args:
-            arg_values.append(f"{arg=}")
-        for arg_name, arg_value in kwargs.items():
-            arg_values.append(f"{arg_name}: {arg_value}")
-        arg_info = " ".join(arg_values)
-        logging.debug(f"{func.__name__} called with: {arg_info}")
+        # Only pay for formatting the arguments when debug logging is on
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("%s called with: args=%r kwargs=%r", func.__name__, args, kwargs)
         return_val = func(*args, **kwargs)
-        logging.debug(f"{func.__name__} done {return_val}")
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug("%s done %r", func.__name__, return_val)
         return return_val
     return log_call
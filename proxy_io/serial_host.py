@@ -8,9 +8,14 @@ serial interface return responses over the serial interface.
 __copyright__ = "Compute Thing Ltd"
 
 from enum import Enum, auto
+from functools import lru_cache
+import itertools
 import logging
+import os
 import queue
+import selectors
 from serial import Serial, serial_for_url
+import socket
 import threading
 from queue import Empty, Queue
 
@@ -19,6 +24,17 @@ from typing import Final, Sequence, List
 
 from serial.serialutil import PortNotOpenError
 
+# Time to wait for the MCU to start replying to a command
+RESPONSE_TIMEOUT: Final = 2
+# Quiet time on the serial line that marks the end of a multi-line response
+LINE_TIMEOUT: Final = 0.05
+# Commands that can be waiting for the serial interface
+INPUT_QUEUE_SIZE: Final = 32
+# Time to wait for space on a full serial interface queue
+QUEUE_PUT_TIMEOUT: Final = 1
+# Interval to check for unsolicited output where the serial port cannot be selected on
+POLL_INTERVAL: Final = 0.1
+
 
 class ConnectionType(Enum):
     SPI = auto(),
@@ -43,6 +59,81 @@ class SerialCommand(Enum):
     EXCEPTION = auto()
 
 
+# Command names as sent to the MCU
+COMMAND_NAMES: Final = {command: command.name for command in SerialCommand}
+# Commands whose response runs over several lines, as sent to the MCU
+MULTI_LINE_COMMANDS: Final = frozenset(
+    bytes(command.name, encoding="UTF-8")
+    for command in (SerialCommand.HELP, SerialCommand.DIO_LIST, SerialCommand.RELAY_LIST)
+    )
+# Markers for failure responses from the MCU, with the command and data key reported for them
+RESPONSE_LEADS: Final = {
+    "ERROR:": (SerialCommand.ERROR, "error"),
+    "EXCEPTION:": (SerialCommand.EXCEPTION, "exception"),
+    "TIMEOUT": (SerialCommand.ERROR, "error"),
+}
+# Time to wait for a response to quick commands, other commands use DEFAULT_COMMAND_TIMEOUT
+COMMAND_TIMEOUTS: Final = {
+    SerialCommand.VERSION: 1.0,
+    SerialCommand.DIO_DIRECTION: 0.5,
+    SerialCommand.DIO_CLEAR: 0.5,
+    SerialCommand.DIO_SET: 0.5,
+    SerialCommand.DIO_READ: 0.5,
+    SerialCommand.RELAY_SET: 0.5,
+    SerialCommand.RELAY_CLEAR: 0.5,
+    SerialCommand.SPI_SEND: 1.0,
+    SerialCommand.SPI_RECEIVE: 1.0,
+}
+# Long enough to see a TIMEOUT from the serial interface when the MCU sends nothing.
+# Replies that arrive after the caller stops waiting are discarded by sequence number.
+DEFAULT_COMMAND_TIMEOUT: Final = RESPONSE_TIMEOUT + 1
+
+
+@lru_cache(maxsize=64)
+def encode_command(name: str, data: str) -> bytes:
+    """Build the serial command line for a command, cached as commands are often repeated."""
+    return bytes(name + " " + data + "\r\n", encoding="UTF-8")
+
+
+class WakingQueue(Queue):
+    """
+    Queue that can be waited on by a selector alongside the serial port.
+
+    Every put writes a byte to an internal socket pair, so the queue reads as ready
+    until clear_wakeups is called.
+    """
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+
+    def _put(self, item):
+        super()._put(item)
+        self.wake()
+
+    def wake(self):
+        try:
+            self._wakeup_writer.send(b"\0")
+        except OSError:
+            # Plenty of wake ups are already pending, or the queue has been closed
+            pass
+
+    def clear_wakeups(self):
+        try:
+            while self._wakeup_reader.recv(1024):
+                pass
+        except BlockingIOError:
+            pass
+
+    def fileno(self):
+        return self._wakeup_reader.fileno()
+
+    def close(self):
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+
 class SerialInterface(threading.Thread):
     """
     Wrapper for a physical serial interface.
@@ -54,9 +145,13 @@ class SerialInterface(threading.Thread):
     Commands are passed in input queue as a dictionary as follows:
     cmd_dict = {
         "service": DIO | SPI
-        "command": <SerialCommands>
-        "data"
+        "cmd_bytes": <encoded command line, see encode_command>
+        "sequence": <optional, returned with the response>
+        "deadline": <optional, time.monotonic() after which the command is dropped unsent>
     }
+
+    Responses are put on the service queue as (sequence, response_text) tuples,
+    with a sequence of None for output unrelated to a command.
     """
     def __init__(self, serial_port):
         """
@@ -71,45 +166,122 @@ class SerialInterface(threading.Thread):
         self.serial_port = serial_port
         self.connected = False
         self.alive = False
-        self.input_q = Queue()
+        # Bounded, so commands back up to the caller if the MCU stalls
+        self.input_q = WakingQueue(maxsize=INPUT_QUEUE_SIZE)
         self.service_qs = {}
         self.next_response_q = None
+        # Start of a line of unrelated output that has not been completed yet
+        self.partial_line = b""
         super().__init__()
+        self.daemon = True
 
     def register(self, service: ConnectionType, service_q: Queue):
         self.service_qs[service] = service_q
 
     def run(self):
         self.alive = True
-        with serial_for_url(self.serial_port, baudrate=115200, timeout=2) as serial_connection:
-            while self.alive:
-                try:
-                    cmd_dict = self.input_q.get(True, 0.1)
-                except (Empty, TimeoutError):
-                    # Catch any output unrelated to a command
-                    response_bytes = serial_connection.readlines()
-                    response_text = [line.decode("UTF-8") for line in response_bytes]
-                    if response_text:
-                        self.next_response_q.put(response_text)
-                else:
-                    self.next_response_q = self.service_qs[cmd_dict["service"]]
-                    serial_command_str = cmd_dict["command"].name + " " + cmd_dict["data"] + "\r\n"
-                    try:
-                        serial_connection.write(bytes(serial_command_str, encoding="UTF-8"))
-                    except PortNotOpenError:
-                        response_text = "ERROR: Cannot send DIO command as serial port not open."
+        try:
+            with serial_for_url(self.serial_port, baudrate=115200, timeout=RESPONSE_TIMEOUT) as serial_connection:
+                # Discard any boot banner or partial output left from before connecting
+                serial_connection.reset_input_buffer()
+                serial_connection.reset_output_buffer()
+                with selectors.DefaultSelector() as selector:
+                    selector.register(self.input_q, selectors.EVENT_READ)
+                    if self.register_serial(selector, serial_connection):
+                        wait_timeout = None
                     else:
-                        for _interval in range(20):
-                            if serial_connection.in_waiting:
-                                response_bytes = serial_connection.readlines()
-                                response_text = [line.decode("UTF-8") for line in response_bytes]
-                                if response_text[0] == serial_command_str:
-                                    _commandecho = response_text.pop(0)
+                        # Serial port cannot be selected on, so poll it for unsolicited output
+                        wait_timeout = POLL_INTERVAL
+                    while self.alive:
+                        selector.select(wait_timeout)
+                        self.input_q.clear_wakeups()
+                        while True:
+                            try:
+                                cmd_dict = self.input_q.get_nowait()
+                            except Empty:
                                 break
-                            time.sleep(0.1)
-                        else:
-                            response_text = ["TIMEOUT"]
-                    self.next_response_q.put(response_text)
+                            self.send_command(serial_connection, cmd_dict)
+                        if serial_connection.in_waiting:
+                            # Catch any output unrelated to a command
+                            response_text = self.read_unrelated_output(serial_connection)
+                            if response_text and self.next_response_q:
+                                self.next_response_q.put((None, response_text))
+        finally:
+            self.input_q.close()
+
+    def read_unrelated_output(self, serial_connection) -> List[str]:
+        """
+        Read the complete lines of output waiting on the serial port.
+
+        A trailing partial line is held back until the rest of it arrives, so neither
+        lines nor multi-byte characters are split across reads.
+        """
+        response_bytes = self.partial_line + serial_connection.read(serial_connection.in_waiting)
+        complete_lines, newline, self.partial_line = response_bytes.rpartition(b"\n")
+        return self.decode_lines(complete_lines + newline)
+
+    @staticmethod
+    def register_serial(selector, serial_connection) -> bool:
+        """
+        Register the serial port with the selector so its output wakes the interface.
+
+        Only POSIX serial ports are backed by a selectable file descriptor, so returns
+        False where the port cannot be registered.
+        """
+        if os.name != "posix":
+            return False
+        try:
+            selector.register(serial_connection, selectors.EVENT_READ)
+        except (AttributeError, ValueError, OSError):
+            return False
+        return True
+
+    def send_command(self, serial_connection, cmd_dict):
+        """Send a queued command and pass its response to the service that sent it."""
+        if "deadline" in cmd_dict and time.monotonic() >= cmd_dict["deadline"]:
+            # The caller has already reported the command as failed
+            logging.debug(f"Dropped expired command: {cmd_dict['cmd_bytes']}")
+            return
+        self.next_response_q = self.service_qs[cmd_dict["service"]]
+        serial_command_bytes = cmd_dict["cmd_bytes"]
+        try:
+            serial_connection.write(serial_command_bytes)
+        except PortNotOpenError:
+            response_text = "ERROR: Cannot send DIO command as serial port not open."
+        else:
+            response_bytes = self.read_response(serial_connection, serial_command_bytes)
+            if response_bytes:
+                response_text = self.decode_lines(response_bytes)
+            else:
+                response_text = ["TIMEOUT"]
+        self.next_response_q.put((cmd_dict.get("sequence"), response_text))
+
+    @staticmethod
+    def read_response(serial_connection, serial_command_bytes: bytes) -> bytes:
+        """
+        Read the lines of response to a command, dropping the MCU echo of the command.
+
+        Blocks for up to RESPONSE_TIMEOUT for the first line, so returns as soon as the
+        MCU replies rather than polling. Only MULTI_LINE_COMMANDS wait for further lines,
+        which are collected until none arrive within LINE_TIMEOUT.
+        """
+        line = serial_connection.readline()
+        if line.strip() == serial_command_bytes.strip():
+            line = serial_connection.readline()
+        if not line or serial_command_bytes.split(maxsplit=1)[0] not in MULTI_LINE_COMMANDS:
+            return line
+        serial_connection.timeout = LINE_TIMEOUT
+        response_lines = []
+        while line:
+            response_lines.append(line)
+            line = serial_connection.readline()
+        serial_connection.timeout = RESPONSE_TIMEOUT
+        return b"".join(response_lines)
+
+    @staticmethod
+    def decode_lines(response_bytes: bytes) -> List[str]:
+        """Decode a chunk of serial output in one go and split it into lines."""
+        return response_bytes.decode("UTF-8", "replace").splitlines()
 
     def close_service(self, service):
         _removed = self.service_qs.pop(service, None)
@@ -118,6 +290,7 @@ class SerialInterface(threading.Thread):
 
     def close(self):
         self.alive = False
+        self.input_q.wake()
         self.join(timeout=2)
 
 
@@ -137,6 +310,7 @@ class SharedSerial:
         self.service = service
         self.connected = False
         self.response_q = Queue()
+        self.sequence = itertools.count()
         self.serial_interface = self.obtain_serial_interface(serial_port, service)
         super().__init__()
 
@@ -154,13 +328,16 @@ class SharedSerial:
             command = SerialCommand.ERROR
             data = {"error": "No response from MCU"}
         else:
-            response_fields = text_response[0].split()
-            if "ERROR:" in response_fields[:2]:
-                command = SerialCommand.ERROR
-                data = {"error": text_response[0]}
-            if "EXCEPTION:" in response_fields[:2]:
-                command = SerialCommand.EXCEPTION
-                data = {"exception": text_response[0]}
+            # Only the command name and the field after it are needed to classify the response
+            response_fields = text_response[0].split(maxsplit=2)
+            lead = None
+            for field in response_fields[:2]:
+                lead = RESPONSE_LEADS.get(field)
+                if lead:
+                    break
+            if lead:
+                command, key = lead
+                data = {key: text_response[0]}
             else:
                 command = SerialCommand[response_fields[0]]
                 data = " ".join(response_fields[1:])
@@ -175,7 +352,6 @@ class SharedSerial:
     def obtain_serial_interface(self, serial_port, service):
         if serial_port not in self.__class__.serial_interfaces:
             serial_interface = SerialInterface(serial_port)
-            serial_interface.daemon = True
             serial_interface.start()
             time.sleep(0.01)
             self.__class__.serial_interfaces[serial_port] = serial_interface
@@ -198,17 +374,44 @@ class SharedSerial:
     def is_connected(self):
         return self.connected
 
-    def handle_command(self, command, data):
+    def handle_command(self, command, data, timeout: float = None):
+        """
+        Send a command to the MCU and return the cleaned response.
+
+        timeout overrides the time to wait for a response, which otherwise
+        depends on the command, see COMMAND_TIMEOUTS.
+        """
+        if timeout is None:
+            timeout = COMMAND_TIMEOUTS.get(command, DEFAULT_COMMAND_TIMEOUT)
+        sequence = next(self.sequence)
+        # Past this the caller has given up, so the command must not be sent
+        deadline = time.monotonic() + timeout
         message_to_send = {
             "service": self.service,
-            "command": command,
-            "data": data
+            "cmd_bytes": encode_command(COMMAND_NAMES[command], data),
+            "sequence": sequence,
+            "deadline": deadline
         }
-        self.serial_interface.input_q.put(message_to_send)
         try:
-            raw_response = self.response_q.get(True, 10)
-        except queue.Empty:
-            raw_response = ""
+            self.serial_interface.input_q.put(message_to_send, timeout=QUEUE_PUT_TIMEOUT)
+        except queue.Full:
+            return {
+                "command": SerialCommand.ERROR,
+                "data": {"error": "Serial interface busy, command not sent"}
+            }
+        raw_response = ""
+        while True:
+            try:
+                response_sequence, response_text = self.response_q.get(
+                    True, max(0, deadline - time.monotonic())
+                    )
+            except queue.Empty:
+                break
+            # Anything else is a late reply to an earlier command that timed out
+            # or output unrelated to a command
+            if response_sequence == sequence:
+                raw_response = response_text
+                break
         cleaned = self.clean_response(raw_response)
         if "error" in cleaned or "exception" in cleaned:
             for key, value in cleaned.items():
@@ -411,7 +614,7 @@ class SpiIo(BaseIo):
     def receive_message(self, receive_length: int) -> bytes:
         response = self.shared_serial.handle_command(
             SerialCommand.SPI_RECEIVE,
-            bytes([receive_length])
+            f"{receive_length:02x}"
             )
         print(response)
         return response
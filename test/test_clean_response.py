@@ -0,0 +1,33 @@
+from serial_host import SharedSerial, SerialCommand
+
+
+def test_error_in_place_of_command():
+    response = SharedSerial.clean_response(["ERROR: Unknown Pin: 9"])
+    assert response["command"] == SerialCommand.ERROR
+    assert response["data"] == {"error": "ERROR: Unknown Pin: 9"}
+
+def test_error_after_command():
+    response = SharedSerial.clean_response(["DIO_SET ERROR: Cannot set pin: 3"])
+    assert response["command"] == SerialCommand.ERROR
+    assert response["data"] == {"error": "DIO_SET ERROR: Cannot set pin: 3"}
+
+def test_exception():
+    response = SharedSerial.clean_response(["EXCEPTION: Could not run: DIO_READ because index"])
+    assert response["command"] == SerialCommand.EXCEPTION
+    assert response["data"] == {"exception": "EXCEPTION: Could not run: DIO_READ because index"}
+
+def test_timeout():
+    response = SharedSerial.clean_response(["TIMEOUT"])
+    assert response["command"] == SerialCommand.ERROR
+
+def test_normal_reply():
+    response = SharedSerial.clean_response(["SPI_SEND Sent: 01 02"])
+    assert response["command"] == SerialCommand.SPI_SEND
+    assert response["data"] == "Sent: 01 02"
+    assert "extension" not in response
+
+def test_multi_line_reply():
+    response = SharedSerial.clean_response(["DIO_LIST ", "    0 GP0 INPUT False", "    1 GP1 OUTPUT True"])
+    assert response["command"] == SerialCommand.DIO_LIST
+    assert response["data"] == ""
+    assert response["extension"] == "    0 GP0 INPUT False\n    1 GP1 OUTPUT True"
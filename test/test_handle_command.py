@@ -0,0 +1,35 @@
+import queue
+import time
+from serial import serial_for_url
+import serial_host
+from serial_host import SerialInterface, SharedSerial, SerialCommand, ConnectionType, encode_command
+
+
+def test_expired_command_is_not_sent():
+    serial_interface = SerialInterface("loop://")
+    service_q = queue.Queue()
+    serial_interface.register(ConnectionType.RELAY, service_q)
+    message_to_send = {
+        "service": ConnectionType.RELAY,
+        "cmd_bytes": encode_command("RELAY_SET", "0"),
+        "sequence": 0,
+        "deadline": time.monotonic() - 1
+    }
+    with serial_for_url("loop://", timeout=0) as serial_connection:
+        serial_interface.send_command(serial_connection, message_to_send)
+        assert serial_connection.in_waiting == 0
+    assert service_q.empty()
+    serial_interface.input_q.close()
+
+def test_full_input_queue_reports_error(monkeypatch):
+    monkeypatch.setattr(serial_host, "QUEUE_PUT_TIMEOUT", 0.01)
+    # Never started, so nothing drains its input queue
+    serial_interface = SerialInterface("unit-test")
+    monkeypatch.setitem(SharedSerial.serial_interfaces, "unit-test", serial_interface)
+    shared_serial = SharedSerial("unit-test", service=ConnectionType.DIO)
+    while not serial_interface.input_q.full():
+        serial_interface.input_q.put({})
+    response = shared_serial.handle_command(SerialCommand.DIO_READ, "1")
+    assert response["command"] == SerialCommand.ERROR
+    assert "error" in response["data"]
+    serial_interface.input_q.close()
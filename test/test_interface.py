@@ -2,7 +2,7 @@ import logging
 import queue
 import pytest
 import os
-from serial_host import SerialInterface, SerialCommand, ConnectionType
+from serial_host import SerialInterface, SerialCommand, ConnectionType, encode_command
 
 if os.name == 'nt':
     SERIAL_INTERFACE = "COM4"
@@ -43,14 +43,15 @@ def test_version(serial_binding):
     serial_interface, service_q = serial_binding
     message_to_send = {
         "service": ConnectionType.DIO,
-        "command": SerialCommand.VERSION,
-        "data": ""
+        "cmd_bytes": encode_command(SerialCommand.VERSION.name, ""),
+        "sequence": 0
     }
     serial_interface.input_q.put(message_to_send)
     try:
-        response = service_q.get(True, 10)
+        sequence, response = service_q.get(True, 10)
     except queue.Empty:
         assert False
+    assert sequence == 0
     assert "VERSION" in response[0]
     assert len(response[0].split()) == 2
 
@@ -0,0 +1,41 @@
+import selectors
+import time
+from serial import serial_for_url
+from serial_host import SerialInterface, WakingQueue
+
+
+def test_put_makes_queue_ready():
+    waking_q = WakingQueue()
+    with selectors.DefaultSelector() as selector:
+        selector.register(waking_q, selectors.EVENT_READ)
+        assert not selector.select(0)
+        waking_q.put("command")
+        assert selector.select(0)
+        waking_q.clear_wakeups()
+        assert not selector.select(0)
+        assert waking_q.get_nowait() == "command"
+    waking_q.close()
+
+def test_wake_after_close_is_ignored():
+    waking_q = WakingQueue()
+    waking_q.close()
+    waking_q.put("command")
+    assert waking_q.get_nowait() == "command"
+
+def test_close_stops_run():
+    serial_interface = SerialInterface("loop://")
+    serial_interface.start()
+    while not serial_interface.alive:
+        time.sleep(0.01)
+    serial_interface.close()
+    assert not serial_interface.is_alive()
+    assert serial_interface.input_q.fileno() == -1
+
+def test_unrelated_output_holds_back_partial_line():
+    serial_interface = SerialInterface("loop://")
+    with serial_for_url("loop://", timeout=0) as serial_connection:
+        serial_connection.write("first\r\nsecond é".encode("UTF-8")[:-1])
+        assert serial_interface.read_unrelated_output(serial_connection) == ["first"]
+        serial_connection.write("é".encode("UTF-8")[-1:] + b" line\r\n")
+        assert serial_interface.read_unrelated_output(serial_connection) == ["second é line"]
+    serial_interface.input_q.close()